@@ -1,11 +1,12 @@
 # main.py
 import time
-from typing import Optional
+import msgpack
+from typing import Any, Awaitable, Callable, Dict
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, status
 from starlette.responses import JSONResponse
 from pydantic import ValidationError
 
-from manager import PubSubManager
+from manager import PubSubManager, SendPump
 import models
 
 app = FastAPI()
@@ -35,66 +36,85 @@ async def health_check() -> models.HealthResponse:
     stats.uptime_sec = int(time.time() - start_time)
     return stats
 
-@app.get("/stats", status_code=status.HTTP_200_OK)
-async def get_stats() -> models.StatsResponse:
+@app.get("/stats", status_code=status.HTTP_200_OK, response_model=models.StatsResponse)
+async def get_stats() -> Dict[str, Any]:
+    # A plain dict; FastAPI serializes it against response_model in pydantic-core
     return await manager.get_full_stats()
 
-# --- WebSocket Endpoint (placeholder for now) ---
-# main.py
-# (Replace the old @app.websocket("/ws") with this new version)
+# --- WebSocket Endpoint ---
+
+# Handlers for validated client messages; each returns the ack frame to send back
+
+async def _handle_subscribe(msg: models.ClientSubscribeMessage, pump: SendPump) -> models.Frame:
+    pump.websocket.state.client_id = msg.client_id # Associate client_id with this connection
+    await manager.subscribe(msg.topic, msg.client_id, pump, msg.last_n or 0) # last_n may be sent as null
+    return models.ack_frame(msg.request_id, msg.topic)
+
+async def _handle_unsubscribe(msg: models.ClientUnsubscribeMessage, pump: SendPump) -> models.Frame:
+    await manager.unsubscribe(msg.topic, msg.client_id)
+    return models.ack_frame(msg.request_id, msg.topic)
+
+async def _handle_publish(msg: models.ClientPublishMessage, pump: SendPump) -> models.Frame:
+    await manager.publish(msg.topic, msg.message)
+    return models.ack_frame(msg.request_id, msg.topic)
+
+# Pings never reach the table; the endpoint answers them before validation
+HANDLERS: Dict[type, Callable[[Any, SendPump], Awaitable[models.Frame]]] = {
+    models.ClientSubscribeMessage: _handle_subscribe,
+    models.ClientUnsubscribeMessage: _handle_unsubscribe,
+    models.ClientPublishMessage: _handle_publish,
+}
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    client_id: Optional[str] = None
+    binary = models.MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+    await websocket.accept(subprotocol=models.MSGPACK_SUBPROTOCOL if binary else None)
+    pump = SendPump(websocket, binary=binary)
+    websocket.state.client_id = None
     try:
         while True:
-            data = await websocket.receive_json()
+            if binary:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                if message.get("bytes") is None:
+                    await pump.write(models.error_frame(None, "BAD_REQUEST", "Expected a binary msgpack frame"))
+                    continue
+                try:
+                    data = msgpack.unpackb(message["bytes"])
+                except ValueError as e:
+                    # FormatError, ExtraData and truncated input are all ValueErrors
+                    await pump.write(models.error_frame(None, "BAD_REQUEST", f"Invalid msgpack frame: {e}"))
+                    continue
+            else:
+                data = await websocket.receive_json()
+
+            if not isinstance(data, dict):
+                await pump.write(models.error_frame(None, "BAD_REQUEST", "Message must be an object"))
+                continue
 
             try:
-                msg_type = data.get("type")
                 request_id = data.get("request_id")
 
-                if msg_type == "subscribe":
-                    msg = models.ClientSubscribeMessage(**data)
-                    client_id = msg.client_id # Associate client_id with this connection
-                    await manager.subscribe(msg.topic, msg.client_id, websocket, msg.last_n)
-                    ack = models.ServerAckMessage(request_id=request_id, topic=msg.topic)
-                    await websocket.send_json(ack.dict())
-
-                elif msg_type == "unsubscribe":
-                    msg = models.ClientUnsubscribeMessage(**data)
-                    await manager.unsubscribe(msg.topic, msg.client_id)
-                    ack = models.ServerAckMessage(request_id=request_id, topic=msg.topic)
-                    await websocket.send_json(ack.dict())
-
-                elif msg_type == "publish":
-                    msg = models.ClientPublishMessage(**data)
-                    await manager.publish(msg.topic, msg.message)
-                    ack = models.ServerAckMessage(request_id=request_id, topic=msg.topic)
-                    await websocket.send_json(ack.dict())
-
-                elif msg_type == "ping":
-                    msg = models.ClientPingMessage(**data)
-                    pong = models.ServerPongMessage(request_id=request_id)
-                    await websocket.send_json(pong.dict())
-
-                else:
-                    raise ValueError("Unsupported message type")
+                # Pings carry nothing worth validating, so answer them before the adapter runs
+                if data.get("type") == "ping":
+                    await pump.write(models.pong_frame(request_id))
+                    continue
+
+                # One compiled validation call picks the model by its "type" tag
+                msg = models.CLIENT_ADAPTER.validate_python(data)
+                await pump.write(await HANDLERS[type(msg)](msg, pump))
 
             except ValidationError as e:
-                error_payload = models.ErrorPayload(code="BAD_REQUEST", message=str(e))
-                error_msg = models.ServerErrorMessage(request_id=request_id, error=error_payload)
-                await websocket.send_json(error_msg.dict())
+                await pump.write(models.error_frame(request_id, "BAD_REQUEST", str(e)))
 
             except ValueError as e:
-                error_payload = models.ErrorPayload(code=str(e), message="Operation failed")
-                error_msg = models.ServerErrorMessage(request_id=request_id, error=error_payload)
-                await websocket.send_json(error_msg.dict())
+                await pump.write(models.error_frame(request_id, str(e), "Operation failed"))
 
     except WebSocketDisconnect:
-        print(f"Client '{client_id}' disconnected.")
+        print(f"Client '{websocket.state.client_id}' disconnected.")
 
     finally:
-        if client_id:
-            await manager.disconnect_client(client_id)
\ No newline at end of file
+        if websocket.state.client_id:
+            await manager.disconnect_client(websocket.state.client_id)
+        await pump.close()
@@ -1,32 +1,214 @@
 # manager.py
 import asyncio
-import collections
-from typing import Dict, List, Set, Deque
-from fastapi import WebSocket, HTTPException
+import contextlib
+import os
+from typing import Dict, List, Optional, Set, Tuple, cast
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException
 from starlette.websockets import WebSocketState
 import models
 
+# Number of lock stripes guarding per-topic operations; must be a power of two
+LOCK_STRIPES = 64
+
+# Flush window and cap on the number of events coalesced into one frame
+BATCH_DELAY_SEC = 0.002
+BATCH_MAX_EVENTS = 64
+
+# Subscribers served per fan-out chunk before yielding back to the event loop (at least 1)
+BROADCAST_CHUNK_SIZE = max(1, int(os.environ.get("BROADCAST_CHUNK_SIZE", "50")))
+
+# Number of recent events each topic keeps for last_n replay
+HISTORY_SIZE = 100
+
+# Events a connection may have queued before it is dropped as a slow consumer;
+# never below HISTORY_SIZE, so a full last_n replay fits in an empty queue
+SEND_QUEUE_SIZE = max(HISTORY_SIZE, int(os.environ.get("SEND_QUEUE_SIZE", "1024")))
+
+# WebSocket close code sent to a slow consumer ("Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# WebSocket close code sent when delivery fails for a reason other than a dead socket
+INTERNAL_ERROR_CLOSE_CODE = 1011
+
+class SendPump:
+    """Owns outbound event delivery for one WebSocket connection.
+
+    Events are queued without blocking the publisher; a background task waits
+    BATCH_DELAY_SEC after the first one arrives and flushes everything queued
+    by then as a single batch frame. Frames go out as msgpack when the
+    connection negotiated models.MSGPACK_SUBPROTOCOL, JSON text otherwise.
+
+    The queue is bounded by SEND_QUEUE_SIZE; a client that falls that far
+    behind is disconnected rather than allowed to buffer without limit.
+    """
+    def __init__(self, websocket: WebSocket, binary: bool = False):
+        self.websocket = websocket
+        self.binary = binary
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+        self._closer: Optional[asyncio.Task] = None
+
+    def send(self, event: models.Frame) -> bool:
+        """Queues an event frame for delivery; returns False if the pump is closed or full."""
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.closed = True
+            self._task.cancel()
+            self._closer = asyncio.create_task(self._close_socket(SLOW_CONSUMER_CLOSE_CODE))
+            return False
+        return True
+
+    async def write(self, frame: models.Frame):
+        """Sends a frame immediately, bypassing the batch queue."""
+        if self.binary:
+            await self.websocket.send_bytes(frame.binary)
+        else:
+            await self.websocket.send_text(frame.text)
+
+    async def close(self):
+        """Stops the pump, dropping anything still queued."""
+        self.closed = True
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+    async def _close_socket(self, code: int):
+        # The socket may already be gone, in which case there is nothing to close
+        with contextlib.suppress(Exception):
+            await self.websocket.close(code=code)
+
+    async def _run(self):
+        try:
+            while True:
+                events = [await self._queue.get()]
+                await asyncio.sleep(BATCH_DELAY_SEC)
+                while len(events) < BATCH_MAX_EVENTS and not self._queue.empty():
+                    events.append(self._queue.get_nowait())
+
+                if len(events) == 1:
+                    await self.write(events[0])
+                elif self.binary:
+                    await self.websocket.send_bytes(models.batch_binary(events))
+                else:
+                    await self.websocket.send_text(models.batch_text(events))
+        except (WebSocketDisconnect, OSError):
+            # The socket is gone; the next broadcast will prune this subscriber
+            self.closed = True
+        except Exception as e:
+            # Anything else leaves the socket open, so close it to tell the client it was dropped
+            print(f"Send pump for client '{getattr(self.websocket.state, 'client_id', None)}' failed: {e!r}")
+            self.closed = True
+            await self._close_socket(INTERNAL_ERROR_CLOSE_CODE)
+
+
+class RingBuffer:
+    """Fixed-capacity history of the most recent event frames, oldest overwritten first."""
+    __slots__ = ("_slots", "_pos", "_len")
+
+    def __init__(self, capacity: int = HISTORY_SIZE):
+        self._slots: List[Optional[models.Frame]] = [None] * capacity
+        self._pos = 0  # index the next frame is written to
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def append(self, frame: models.Frame):
+        capacity = len(self._slots)
+        self._slots[self._pos] = frame
+        self._pos = (self._pos + 1) % capacity
+        if self._len < capacity:
+            self._len += 1
+
+    def last(self, n: int) -> List[models.Frame]:
+        """Returns up to the n most recent frames, oldest first, without copying the rest."""
+        n = min(n, self._len)
+        start = self._pos - n
+        if start >= 0:
+            window = self._slots[start:self._pos]
+        else:
+            # The requested window wraps past the end of the backing list
+            window = self._slots[start:] + self._slots[:self._pos]
+        # The window covers only the n <= _len most recently written slots, so none is None
+        return cast(List[models.Frame], window)
+
+
+Subscribers = Tuple[Tuple[str, SendPump], ...]
+
 class Topic:
     """Encapsulates all state for a single topic."""
     def __init__(self, name: str):
         self.name = name
-        self.subscribers: Dict[str, WebSocket] = {}
-        self.message_history: Deque[models.ServerEventMessage] = collections.deque(maxlen=100)
+        # Mutate only through add_subscriber/discard_subscriber so the cached snapshot stays valid
+        self.subscribers: Dict[str, SendPump] = {}
+        self._snapshot: Optional[Subscribers] = None
+        # How many subscribers use msgpack, so publish knows which encodings to prepare
+        self.binary_subscribers = 0
+        # Broadcast-ready event frames, so replay never rebuilds or re-encodes them
+        self.message_history = RingBuffer()
         self.message_count: int = 0
+        # Guards subscriber/history mutation; fan-out runs on a snapshot outside it
+        self.lock = asyncio.Lock()
+        # Serializes fan-outs so subscribers see events in history order
+        self.dispatch_lock = asyncio.Lock()
+        # Set by delete_topic, for callers that looked the topic up before it went away
+        self.deleted = False
 
-    async def broadcast(self, message: models.ServerEventMessage):
-        """Sends a message to all subscribers of this topic."""
-        disconnected_clients: List[str] = []
-        for client_id, websocket in list(self.subscribers.items()):
+    def add_subscriber(self, client_id: str, pump: SendPump):
+        previous = self.subscribers.get(client_id)
+        if previous is not None and previous.binary:
+            self.binary_subscribers -= 1
+        self.subscribers[client_id] = pump
+        if pump.binary:
+            self.binary_subscribers += 1
+        self._snapshot = None
+
+    def discard_subscriber(self, client_id: str):
+        pump = self.subscribers.pop(client_id, None)
+        if pump is not None:
+            if pump.binary:
+                self.binary_subscribers -= 1
+            self._snapshot = None
+
+    def snapshot(self) -> Subscribers:
+        """Returns an immutable view of the subscribers, rebuilt only after they change."""
+        if self._snapshot is None:
+            self._snapshot = tuple(self.subscribers.items())
+        return self._snapshot
+
+    async def broadcast(self, payload: models.Frame, subscribers: Subscribers) -> List[Tuple[str, SendPump]]:
+        """Queues an encoded event on a snapshot of subscribers.
+
+        Never waits on a socket, so a slow client can't hold up the fan-out,
+        and yields every BROADCAST_CHUNK_SIZE subscribers so a large topic
+        doesn't starve other connections; returns the subscribers that turned
+        out to be disconnected.
+        """
+        disconnected_clients: List[Tuple[str, SendPump]] = []
+        for index, (client_id, pump) in enumerate(subscribers):
+            if index and index % BROADCAST_CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
             # use getattr to avoid attribute errors on different WebSocket implementations
-            if getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
-                await websocket.send_json(message.dict())
-            else:
-                disconnected_clients.append(client_id)
+            if getattr(pump.websocket, "client_state", None) != WebSocketState.CONNECTED or not pump.send(payload):
+                disconnected_clients.append((client_id, pump))
+
+        return disconnected_clients
 
-        # Clean up any disconnected clients found during broadcast
-        for client_id in disconnected_clients:
-            del self.subscribers[client_id]
+    def remove_stale(self, stale: List[Tuple[str, SendPump]]) -> List[str]:
+        """Drops subscribers that failed a broadcast, unless they have since resubscribed.
+
+        Returns the client_ids actually removed.
+        """
+        removed: List[str] = []
+        for client_id, pump in stale:
+            if self.subscribers.get(client_id) is pump:
+                self.discard_subscriber(client_id)
+                removed.append(client_id)
+        return removed
 
 
 # manager.py
@@ -41,68 +223,98 @@ class PubSubManager:
     def __init__(self):
         self._topics: Dict[str, Topic] = {}
         self._clients: Dict[str, Set[str]] = {}  # client_id -> set of subscribed topics
-        self.lock = asyncio.Lock()
+        # Topic lookups lock only the stripe their name hashes to; the
+        # membership lock additionally serializes topic creation/deletion
+        self._stripes = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+        self._membership_lock = asyncio.Lock()
+
+    def _stripe(self, name: str) -> asyncio.Lock:
+        return self._stripes[hash(name) & (LOCK_STRIPES - 1)]
+
+    def _forget_subscription(self, client_id: str, topic_name: str):
+        # Keeps self._clients in step with the topics' subscriber dicts
+        if client_id in self._clients:
+            self._clients[client_id].discard(topic_name)
+            if not self._clients[client_id]:
+                del self._clients[client_id]
+
+    async def _get_topic(self, name: str) -> Topic:
+        """Looks up a topic, holding its stripe only for the lookup itself."""
+        async with self._stripe(name):
+            topic = self._topics.get(name)
+        if topic is None:
+            raise ValueError("TOPIC_NOT_FOUND")
+        return topic
 
     async def create_topic(self, name: str):
-        async with self.lock:
+        async with self._membership_lock, self._stripe(name):
             if name in self._topics:
                 raise HTTPException(status_code=409, detail="Topic already exists")
             self._topics[name] = Topic(name=name)
 
     async def delete_topic(self, name: str):
-        async with self.lock:
+        async with self._membership_lock, self._stripe(name):
             if name not in self._topics:
                 raise HTTPException(status_code=404, detail="Topic not found")
 
             topic = self._topics[name]
-            info_message = models.ServerInfoMessage(topic=name, msg="topic_deleted")
+            async with topic.lock:
+                # Only bookkeeping under the locks; nothing here awaits a socket
+                topic.deleted = True
+                subscribers = topic.snapshot()
+                for client_id, _ in subscribers:
+                    self._forget_subscription(client_id, name)
+                del self._topics[name]
 
-            # Notify and disconnect all subscribers of this topic
-            for client_id, websocket in list(topic.subscribers.items()):
-                if getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
-                    await websocket.send_json(info_message.dict())
-                    await websocket.close(code=1000)
+        # Notify and disconnect subscribers concurrently with no lock held, so a
+        # slow or vanished peer can't stall operations on topics sharing the stripe
+        info_message = models.info_frame(name, "topic_deleted")
+        await asyncio.gather(
+            *(self._close_deleted_subscriber(pump, info_message) for _, pump in subscribers),
+            return_exceptions=True,
+        )
 
-                # Clean up client's subscription list
-                if client_id in self._clients:
-                    self._clients[client_id].discard(name)
-                    if not self._clients[client_id]:
-                        del self._clients[client_id]
+    @staticmethod
+    async def _close_deleted_subscriber(pump: SendPump, info_message: models.Frame):
+        if getattr(pump.websocket, "client_state", None) == WebSocketState.CONNECTED:
+            # The connection is closing, so stop its pump before writing directly
+            await pump.close()
+            await pump.write(info_message)
+            await pump.websocket.close(code=1000)
 
-            del self._topics[name]
+    # The read-only endpoints below take no locks: none of them awaits, so on
+    # the single-threaded event loop each one sees a consistent view of the
+    # topics and never waits behind a publish or a topic deletion.
 
     async def list_topics(self) -> List[str]:
-        async with self.lock:
-            return list(self._topics.keys())
+        return [topic.name for topic in self._topics.values()]
 
     async def get_health_stats(self) -> models.HealthResponse:
-        async with self.lock:
-            total_subscribers = sum(len(topic.subscribers) for topic in self._topics.values())
-            return models.HealthResponse(
-                uptime_sec=0, # Will be calculated in the endpoint
-                topics=len(self._topics),
-                subscribers=total_subscribers
-            )
-
-    async def get_full_stats(self) -> models.StatsResponse:
-        async with self.lock:
-            topic_stats = {
-                name: models.TopicStats(
-                    messages=topic.message_count,
-                    subscribers=len(topic.subscribers)
-                )
-                for name, topic in self._topics.items()
+        topics = self._topics.values()
+        total_subscribers = sum(len(topic.subscribers) for topic in topics)
+        return models.HealthResponse(
+            uptime_sec=0, # Will be calculated in the endpoint
+            topics=len(topics),
+            subscribers=total_subscribers
+        )
+
+    async def get_full_stats(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        # Plain dicts in the StatsResponse/TopicStats shape; no per-topic model construction
+        return {
+            "topics": {
+                topic.name: {"messages": topic.message_count, "subscribers": len(topic.subscribers)}
+                for topic in self._topics.values()
             }
-            return models.StatsResponse(topics=topic_stats)
+        }
 
 
-    async def subscribe(self, topic_name: str, client_id: str, websocket: WebSocket, last_n: int):
-        async with self.lock:
-            if topic_name not in self._topics:
+    async def subscribe(self, topic_name: str, client_id: str, pump: SendPump, last_n: int):
+        topic = await self._get_topic(topic_name)
+        async with topic.lock:
+            if topic.deleted:
                 raise ValueError("TOPIC_NOT_FOUND")
 
-            topic = self._topics[topic_name]
-            topic.subscribers[client_id] = websocket
+            topic.add_subscriber(client_id, pump)
 
             if client_id not in self._clients:
                 self._clients[client_id] = set()
@@ -110,45 +322,55 @@ class PubSubManager:
 
             # Handle message replay for last_n
             if last_n > 0:
-                history = list(topic.message_history)
-                replay_messages = history[-last_n:]
-                for msg_payload in replay_messages:
-                    event = models.ServerEventMessage(topic=topic_name, message=msg_payload)
-                    await websocket.send_json(event.dict())
+                for event in topic.message_history.last(last_n):
+                    # A full queue has already closed the pump as a slow consumer
+                    if not pump.send(event):
+                        break
 
     async def unsubscribe(self, topic_name: str, client_id: str):
-        async with self.lock:
-            if topic_name not in self._topics:
+        topic = await self._get_topic(topic_name)
+        async with topic.lock:
+            if topic.deleted:
                 raise ValueError("TOPIC_NOT_FOUND")
 
-            topic = self._topics[topic_name]
-            if client_id in topic.subscribers:
-                del topic.subscribers[client_id]
-
-            if client_id in self._clients:
-                self._clients[client_id].discard(topic_name)
-                if not self._clients[client_id]:
-                    del self._clients[client_id]
+            topic.discard_subscriber(client_id)
+            self._forget_subscription(client_id, topic_name)
 
     async def publish(self, topic_name: str, message: models.MessagePayload):
-        async with self.lock:
-            if topic_name not in self._topics:
+        topic = await self._get_topic(topic_name)
+        # Encode once; every subscriber and any later replay share the same frame
+        payload = models.event_frame(topic_name, message)
+        async with topic.lock:
+            if topic.deleted:
                 raise ValueError("TOPIC_NOT_FOUND")
 
-            topic = self._topics[topic_name]
-            topic.message_history.append(message)
+            subscribers = topic.snapshot()
+            # Reject unencodable payloads before they reach history or any pump
+            payload.encode(binary=topic.binary_subscribers > 0)
+
+            topic.message_history.append(payload)
             topic.message_count += 1
 
-            event = models.ServerEventMessage(topic=topic_name, message=message)
-            await topic.broadcast(event)
+        # Fan out without topic.lock so subscribes/unsubscribes aren't held up,
+        # but one publish at a time, so the chunked broadcasts can't interleave.
+        # Nothing awaits between releasing topic.lock and queuing on
+        # dispatch_lock, so publishes queue (FIFO) in the order they hit history.
+        async with topic.dispatch_lock:
+            stale = await topic.broadcast(payload, subscribers)
+        if stale:
+            async with topic.lock:
+                for client_id in topic.remove_stale(stale):
+                    self._forget_subscription(client_id, topic_name)
 
     async def disconnect_client(self, client_id: str):
-        async with self.lock:
-            if client_id in self._clients:
-                topics_to_unsubscribe = list(self._clients[client_id])
-                for topic_name in topics_to_unsubscribe:
-                    if topic_name in self._topics:
-                        topic = self._topics[topic_name]
-                        if client_id in topic.subscribers:
-                            del topic.subscribers[client_id]
-                del self._clients[client_id]
\ No newline at end of file
+        topic_names = self._clients.pop(client_id, None)
+        if topic_names is None:
+            return
+
+        # Invariant: a topic name is in self._clients[client_id] exactly while
+        # the client is in that topic's subscribers, and delete_topic forgets
+        # every subscriber before removing the topic, so each name refers to a
+        # live topic. Nothing here awaits, so no delete can interleave and no
+        # locks are needed for these single dict pops.
+        for topic_name in topic_names:
+            self._topics[topic_name].discard_subscriber(client_id)
@@ -1,9 +1,26 @@
 # models.py
-from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional, Literal, Union
+import time
+import msgpack
+import orjson
+from pydantic import BaseModel, Field, TypeAdapter
+from typing import Annotated, List, Dict, Any, Optional, Literal, Union
 from uuid import UUID, uuid4
 from datetime import datetime, timezone
 
+# --- Timestamps ---
+
+_ts_cache_ms = 0
+_ts_cache_iso = ""
+
+def utcnow_iso() -> str:
+    """Current UTC time in ISO-8601, formatted at most once per millisecond."""
+    global _ts_cache_ms, _ts_cache_iso
+    now_ms = time.time_ns() // 1_000_000
+    if now_ms != _ts_cache_ms:
+        _ts_cache_ms = now_ms
+        _ts_cache_iso = datetime.fromtimestamp(now_ms / 1000, timezone.utc).isoformat(timespec="milliseconds")
+    return _ts_cache_iso
+
 # --- Core & REST Models ---
 
 class CreateTopicRequest(BaseModel):
@@ -67,7 +84,11 @@ class ClientPingMessage(BaseModel):
     type: Literal["ping"]
     request_id: Optional[str] = None
 
-ClientMessage = Union
+ClientMessage = Annotated[
+    Union[ClientSubscribeMessage, ClientUnsubscribeMessage, ClientPublishMessage, ClientPingMessage],
+    Field(discriminator="type"),
+]
+CLIENT_ADAPTER = TypeAdapter(ClientMessage)
 
 # --- Server -> Client WebSocket Messages ---
 
@@ -76,27 +97,122 @@ class ServerAckMessage(BaseModel):
     request_id: Optional[str] = None
     topic: Optional[str] = None
     status: str = "ok"
-    ts: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    ts: str = Field(default_factory=utcnow_iso)
 
 class ServerEventMessage(BaseModel):
     type: Literal["event"] = "event"
     topic: str
     message: MessagePayload
-    ts: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    ts: str = Field(default_factory=utcnow_iso)
 
 class ServerErrorMessage(BaseModel):
     type: Literal["error"] = "error"
     request_id: Optional[str] = None
     error: ErrorPayload
-    ts: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    ts: str = Field(default_factory=utcnow_iso)
 
 class ServerPongMessage(BaseModel):
     type: Literal["pong"] = "pong"
     request_id: Optional[str] = None
-    ts: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    ts: str = Field(default_factory=utcnow_iso)
 
 class ServerInfoMessage(BaseModel):
     type: Literal["info"] = "info"
     topic: Optional[str] = None
     msg: str
-    ts: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
\ No newline at end of file
+    ts: str = Field(default_factory=utcnow_iso)
+
+# Several events coalesced into one frame by manager.SendPump
+class ServerBatchMessage(BaseModel):
+    type: Literal["batch"] = "batch"
+    events: List[ServerEventMessage]
+
+# --- Wire Encoding ---
+
+# Connections that offer this subprotocol exchange msgpack binary frames instead of JSON text
+MSGPACK_SUBPROTOCOL = "pubsub.msgpack.v1"
+
+def _msgpack_default(value: Any) -> Any:
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f"Cannot msgpack-encode {type(value).__name__}")
+
+class Frame:
+    """An outbound message, encoded at most once per wire format on first use."""
+    __slots__ = ("data", "_text", "_binary")
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self._text: Optional[str] = None
+        self._binary: Optional[bytes] = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            # orjson encodes the UUID message ids natively
+            self._text = orjson.dumps(self.data).decode()
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(self.data, default=_msgpack_default)
+        return self._binary
+
+    def encode(self, binary: bool = False):
+        """Encodes the frame now, so a payload that can't be serialized fails here
+        rather than later inside a connection's send path.
+
+        Always encodes JSON, plus msgpack when binary is set; raises ValueError
+        if either encoder rejects the data.
+        """
+        try:
+            self.text
+            if binary:
+                self.binary
+        except (TypeError, ValueError, OverflowError) as e:
+            raise ValueError("BAD_REQUEST") from e
+
+# {"type": "batch", "events": <array follows>}
+_BATCH_BINARY_HEADER = (
+    msgpack.Packer().pack_map_header(2)
+    + msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("events")
+)
+
+def batch_text(frames: List[Frame]) -> str:
+    """Splices already-encoded event frames into one JSON ServerBatchMessage frame."""
+    return '{"type":"batch","events":[' + ",".join(frame.text for frame in frames) + "]}"
+
+def batch_binary(frames: List[Frame]) -> bytes:
+    """Splices already-encoded event frames into one msgpack ServerBatchMessage frame."""
+    array_header = msgpack.Packer().pack_array_header(len(frames))
+    return b"".join([_BATCH_BINARY_HEADER, array_header, *(frame.binary for frame in frames)])
+
+# --- Outbound Frame Builders ---
+# The Server* models above document the wire schema; the send path builds the
+# same dicts directly rather than constructing and dumping a model per frame.
+
+def ack_frame(request_id: Optional[str], topic: Optional[str]) -> Frame:
+    return Frame({"type": "ack", "request_id": request_id, "topic": topic, "status": "ok", "ts": utcnow_iso()})
+
+def pong_frame(request_id: Optional[str]) -> Frame:
+    return Frame({"type": "pong", "request_id": request_id, "ts": utcnow_iso()})
+
+def error_frame(request_id: Optional[str], code: str, message: str) -> Frame:
+    return Frame({
+        "type": "error",
+        "request_id": request_id,
+        "error": {"code": code, "message": message},
+        "ts": utcnow_iso(),
+    })
+
+def event_frame(topic: str, message: MessagePayload) -> Frame:
+    return Frame({
+        "type": "event",
+        "topic": topic,
+        "message": {"id": message.id, "payload": message.payload},
+        "ts": utcnow_iso(),
+    })
+
+def info_frame(topic: Optional[str], msg: str) -> Frame:
+    return Frame({"type": "info", "topic": topic, "msg": msg, "ts": utcnow_iso()})
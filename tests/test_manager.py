@@ -0,0 +1,204 @@
+# tests/test_manager.py
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from uuid import uuid4
+
+from starlette.websockets import WebSocketState
+
+import manager
+import models
+
+
+class FakeWebSocket:
+    """Records what the server sends instead of writing to a real connection."""
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.state = SimpleNamespace(client_id=None)
+        self.frames = []
+        self.close_code = None
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+    async def close(self, code=1000):
+        self.close_code = code
+        self.client_state = WebSocketState.DISCONNECTED
+
+    def events(self):
+        """Payload "n" of every event received, with batch frames unpacked in order."""
+        events = []
+        for frame in self.frames:
+            events.extend(frame["events"] if frame["type"] == "batch" else [frame])
+        return [event["message"]["payload"]["n"] for event in events if event["type"] == "event"]
+
+
+def message(n):
+    return models.MessagePayload(id=uuid4(), payload={"n": n})
+
+
+async def flush():
+    # Long enough for every pump to wait out BATCH_DELAY_SEC and write its frames
+    await asyncio.sleep(manager.BATCH_DELAY_SEC * 10)
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_last_across_wrap_around(self):
+        ring = manager.RingBuffer(capacity=5)
+        frames = [models.event_frame("t", message(n)) for n in range(7)]
+        for frame in frames:
+            ring.append(frame)
+
+        self.assertEqual(len(ring), 5)
+        self.assertEqual(ring.last(3), frames[4:])
+        self.assertEqual(ring.last(5), frames[2:])
+        self.assertEqual(ring.last(10), frames[2:])
+        self.assertEqual(ring.last(0), [])
+
+    def test_last_before_full(self):
+        ring = manager.RingBuffer(capacity=5)
+        frames = [models.event_frame("t", message(n)) for n in range(3)]
+        for frame in frames:
+            ring.append(frame)
+
+        self.assertEqual(ring.last(5), frames)
+
+
+class SendPumpTest(unittest.IsolatedAsyncioTestCase):
+    async def test_single_event_is_sent_unbatched(self):
+        websocket = FakeWebSocket()
+        pump = manager.SendPump(websocket)
+        pump.send(models.event_frame("t", message(1)))
+        await flush()
+
+        self.assertEqual(websocket.frames[0]["type"], "event")
+        await pump.close()
+
+    async def test_batches_split_at_max_events(self):
+        websocket = FakeWebSocket()
+        pump = manager.SendPump(websocket)
+        total = manager.BATCH_MAX_EVENTS + 6
+        for n in range(total):
+            self.assertTrue(pump.send(models.event_frame("t", message(n))))
+        await flush()
+
+        self.assertEqual([frame["type"] for frame in websocket.frames], ["batch", "batch"])
+        self.assertEqual(len(websocket.frames[0]["events"]), manager.BATCH_MAX_EVENTS)
+        self.assertEqual(len(websocket.frames[1]["events"]), 6)
+        self.assertEqual(websocket.events(), list(range(total)))
+        await pump.close()
+
+    async def test_queue_overflow_closes_with_1013(self):
+        websocket = FakeWebSocket()
+        with mock.patch.object(manager, "SEND_QUEUE_SIZE", 3):
+            pump = manager.SendPump(websocket)
+        # No await in between, so the writer never gets to drain the queue
+        results = [pump.send(models.event_frame("t", message(n))) for n in range(4)]
+        await asyncio.sleep(0)
+
+        self.assertEqual(results, [True, True, True, False])
+        self.assertTrue(pump.closed)
+        self.assertEqual(websocket.close_code, manager.SLOW_CONSUMER_CLOSE_CODE)
+        self.assertFalse(pump.send(models.event_frame("t", message(4))))
+
+    async def test_unexpected_send_failure_closes_with_1011(self):
+        websocket = FakeWebSocket()
+        websocket.send_text = mock.AsyncMock(side_effect=RuntimeError("boom"))
+        pump = manager.SendPump(websocket)
+        with mock.patch("builtins.print"):
+            pump.send(models.event_frame("t", message(1)))
+            await flush()
+
+        self.assertTrue(pump.closed)
+        self.assertEqual(websocket.close_code, manager.INTERNAL_ERROR_CLOSE_CODE)
+
+
+class PubSubManagerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.manager = manager.PubSubManager()
+        await self.manager.create_topic("t")
+        self.pumps = []
+
+    async def asyncTearDown(self):
+        for pump in self.pumps:
+            await pump.close()
+
+    async def subscribe(self, client_id, topic="t", last_n=0):
+        websocket = FakeWebSocket()
+        pump = manager.SendPump(websocket)
+        self.pumps.append(pump)
+        await self.manager.subscribe(topic, client_id, pump, last_n)
+        return websocket
+
+    async def test_remove_stale_keeps_clients_in_sync(self):
+        gone = await self.subscribe("gone")
+        await self.subscribe("live")
+        gone.client_state = WebSocketState.DISCONNECTED
+
+        await self.manager.publish("t", message(1))
+
+        topic = self.manager._topics["t"]
+        self.assertNotIn("gone", topic.subscribers)
+        self.assertNotIn("gone", self.manager._clients)
+        self.assertEqual(self.manager._clients["live"], {"t"})
+
+        # Deleting the topic and disconnecting afterwards must not trip over "gone"
+        await self.manager.delete_topic("t")
+        await self.manager.disconnect_client("gone")
+        await self.manager.disconnect_client("live")
+        self.assertEqual(self.manager._clients, {})
+
+    async def test_delete_topic_survives_failing_subscriber(self):
+        websocket = await self.subscribe("c")
+        websocket.send_text = mock.AsyncMock(side_effect=RuntimeError("peer gone"))
+
+        await self.manager.delete_topic("t")
+
+        self.assertNotIn("t", self.manager._topics)
+        self.assertEqual(self.manager._clients, {})
+        await self.manager.create_topic("t")
+
+    async def test_unencodable_payload_is_rejected_before_history(self):
+        websocket = await self.subscribe("c")
+
+        with self.assertRaises(ValueError):
+            await self.manager.publish("t", models.MessagePayload(id=uuid4(), payload={"n": 2 ** 70}))
+        await flush()
+
+        topic = self.manager._topics["t"]
+        self.assertEqual(len(topic.message_history), 0)
+        self.assertEqual(topic.message_count, 0)
+        self.assertEqual(websocket.frames, [])
+
+    async def test_events_stay_in_order_with_churn_during_fan_out(self):
+        websockets = {}
+        for i in range(8):
+            websockets[f"c{i}"] = await self.subscribe(f"c{i}")
+
+        with mock.patch.object(manager, "BROADCAST_CHUNK_SIZE", 2):
+            first = asyncio.create_task(self.manager.publish("t", message(1)))
+            await asyncio.sleep(0)  # let the first fan-out start and yield mid-way
+            for client_id in ("c0", "c1", "c2"):
+                await self.manager.unsubscribe("t", client_id)
+            await self.manager.publish("t", message(2))
+            await first
+        await flush()
+
+        for client_id in ("c0", "c1", "c2"):
+            self.assertEqual(websockets[client_id].events(), [1])
+        for client_id in ("c3", "c4", "c5", "c6", "c7"):
+            self.assertEqual(websockets[client_id].events(), [1, 2], client_id)
+
+        # History, and therefore last_n replay, agrees with what subscribers saw
+        late = await self.subscribe("late", last_n=2)
+        await flush()
+        self.assertEqual(late.events(), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()